@@ -56,16 +56,18 @@
 
 # +
 import os
+import functools
+import hashlib
 from glob import glob
 import matplotlib.pyplot as plt
 from matplotlib import patches as mpatches, colors
 import seaborn as sns
 import numpy as np
 import rasterio as rio
+from rasterio.enums import Interleaving, Resampling
 from rasterio.plot import plotting_extent
 from shapely.geometry import mapping
 import earthpy as et
-import earthpy.spatial as es
 import earthpy.plot as ep
 import earthpy.mask as em
 
@@ -73,11 +75,253 @@ import earthpy.mask as em
 sns.set_style('white')
 sns.set(font_scale=1.5)
 
+# GDAL settings used for raster reads and writes: a 512 MB block cache
+# and multithreaded (de)compression
+gdal_options = dict(GDAL_CACHEMAX=512,
+                    GDAL_NUM_THREADS='ALL_CPUS',
+                    GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+                    CPL_VSIL_CURL_ALLOWED_EXTENSIONS='.tif')
+
 # Download data and set working directory
 data = et.data.get_data('cold-springs-fire')
 os.chdir(os.path.join(et.io.HOME, 'earth-analytics'))
 # -
 
+# +
+# Helper functions used throughout this lesson
+
+def build_qa_lut(flag_groups, size=2 ** 16):
+    """Build a read only boolean lookup table of the QA values to mask.
+
+    flag_groups is a list of lists of QA values, for example the cloud and
+    cloud shadow values from em.pixel_flags. The table is True at the index
+    of every value in any group, and covers every 16 bit QA value by default.
+    Values outside 0 to size - 1 can't occur in the QA layer and are skipped.
+    """
+    flagged = frozenset().union(*flag_groups)
+    lut = np.zeros(size, dtype=bool)
+    lut[[val for val in flagged if 0 <= val < size]] = True
+    lut.flags.writeable = False
+    return lut
+
+
+def mask_from_lut(qa_arr, lut):
+    """Return a boolean mask of qa_arr by looking each pixel up in lut."""
+    # NumPy converts lookup indexes to 8 byte integers, so look the
+    # pixels up in blocks rather than converting the whole raster
+    mask = np.empty(qa_arr.shape, dtype=bool)
+    flat_qa = qa_arr.reshape(-1)
+    flat_mask = mask.reshape(-1)
+    block_size = 2 ** 20
+    for start in range(0, flat_qa.size, block_size):
+        stop = start + block_size
+        flat_mask[start:stop] = lut[flat_qa[start:stop]]
+    return mask
+
+
+def create_qa_mask(qa_arr, vals):
+    """Return a boolean array that is True wherever qa_arr equals one of vals.
+
+    Integer QA layers (like the Landsat pixel_qa layer) are masked with a
+    lookup table that covers every possible value of the data type, so the
+    whole raster is processed in one pass. Other data types, or values
+    that the data type cannot hold, use np.isin.
+    """
+    vals = list(vals)
+    if (qa_arr.dtype in (np.uint8, np.uint16)
+            and all(0 <= val <= np.iinfo(qa_arr.dtype).max for val in vals)):
+        lut = build_qa_lut([vals], size=np.iinfo(qa_arr.dtype).max + 1)
+        return mask_from_lut(qa_arr, lut)
+    return np.isin(qa_arr, vals)
+
+
+def stack_bands(infiles, out_path):
+    """Stack single band rasters into one tiled, compressed multiband GeoTIFF.
+
+    The bands are copied into the output one at a time, then internal
+    overviews are added so that plots can read a downsampled copy of the
+    data. An existing stack is reused when it is newer than all of the input
+    files and is a complete, tiled stack with overviews of the same number
+    of bands. The stack is written to a temporary file that only replaces
+    out_path once it is complete.
+    """
+    if os.path.exists(out_path):
+        out_mtime = os.path.getmtime(out_path)
+        if all(out_mtime > os.path.getmtime(fn) for fn in infiles):
+            try:
+                with rio.open(out_path) as dst:
+                    if (dst.count == len(infiles)
+                            and dst.profile.get("tiled")
+                            and dst.overviews(1)):
+                        return out_path
+            except rio.errors.RasterioIOError:
+                # The file is unreadable, so rebuild it
+                pass
+
+    with rio.open(infiles[0]) as src:
+        profile = src.profile
+    profile.update(driver="GTiff",
+                   count=len(infiles),
+                   tiled=True,
+                   blockxsize=512,
+                   blockysize=512,
+                   compress="deflate",
+                   predictor=2,
+                   # Keep each band in its own tiles so that reading a
+                   # few bands (like RGB) does not decode the others
+                   interleave="band")
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = os.path.splitext(out_path)[0] + ".tmp.tif"
+    with rio.open(tmp_path, "w", **profile) as dst:
+        for i, fn in enumerate(infiles):
+            with rio.open(fn) as src:
+                dst.write_band(i + 1, src.read(1))
+
+    # Add overviews (reduced resolution copies) for faster plotting
+    with rio.open(tmp_path, "r+") as dst:
+        dst.build_overviews([2, 4, 8, 16], Resampling.average)
+        dst.update_tags(ns="rio_overview", resampling="average")
+
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def read_for_plot(src, indexes=None, max_size=1024):
+    """Read an open raster at a resolution that is suited for plotting.
+
+    The data are downsampled on read (from the overviews when the file has
+    them) so that the longest side of the array is at most max_size pixels.
+    If indexes (1-based band numbers) are given, only those bands are
+    returned. Files that store each pixel's bands together (pixel
+    interleaved) are read in full and then subset, as reading single bands
+    from them can be slower; other files read just those bands.
+    """
+    pixel_interleaved = src.interleaving == Interleaving.pixel
+    read_indexes = list(range(1, src.count + 1))
+    if indexes is not None and not pixel_interleaved:
+        read_indexes = list(indexes)
+
+    factor = int(np.ceil(max(src.height, src.width) / max_size))
+    out_shape = (len(read_indexes),
+                 -(-src.height // factor),
+                 -(-src.width // factor))
+    arr = src.read(read_indexes,
+                   masked=True,
+                   out_shape=out_shape,
+                   resampling=Resampling.average)
+
+    if indexes is not None and pixel_interleaved:
+        arr = arr[[i - 1 for i in indexes]]
+    return arr
+
+
+def to_display_uint8(arr, clip=2):
+    """Stretch each band of arr to 0-255 and return it as uint8 for plotting.
+
+    Values between the clip and 100 - clip percentiles of each band are
+    scaled to 0-255. 16 bit integer bands are converted with a lookup table
+    that holds the scaled value of every possible pixel value. Use this for
+    display only; keep the original data for any analysis. Bands with no
+    unmasked pixels (e.g. fully clouded) are filled with 0.
+    """
+    out = np.zeros(arr.shape, dtype=np.uint8)
+    for i, band in enumerate(arr):
+        valid = np.ma.compressed(band)
+        if valid.size == 0:
+            continue
+        lo, hi = np.percentile(valid, [clip, 100 - clip])
+        scale = 255.0 / max(hi - lo, 1)
+        data = np.ma.getdata(band)
+        if data.dtype in (np.int16, np.uint16):
+            codes = np.arange(2 ** 16, dtype=np.uint16).view(data.dtype)
+            lut = np.clip((codes - lo) * scale, 0, 255).astype(np.uint8)
+            out[i] = lut[data.view(np.uint16)]
+        else:
+            out[i] = np.clip((data - lo) * scale, 0, 255)
+    return np.ma.masked_array(out, mask=np.ma.getmask(arr))
+
+
+def load_band_cached(path, band=1, cache_dir=os.path.join("data", "cache"),
+                     max_entries=5):
+    """Read one band of a raster, caching the decoded array as a .npy file.
+
+    The cache file is keyed on the path, modification time and size of the
+    raster, so a changed raster is read again. Cached arrays are returned as
+    read only memory maps. Only the max_entries most recently used cache
+    files (named band-*.npy) are kept; other files in cache_dir are left
+    alone.
+    """
+    stat = os.stat(path)
+    key = "{}:{}:{}:{}".format(os.path.abspath(path), stat.st_mtime_ns,
+                               stat.st_size, band)
+    cache_path = os.path.join(cache_dir,
+                              "band-" + hashlib.md5(key.encode()).hexdigest() + ".npy")
+
+    if os.path.exists(cache_path):
+        # Mark the cache file as recently used
+        os.utime(cache_path)
+    else:
+        with rio.open(path) as src:
+            arr = src.read(band)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so an interrupted save never
+        # leaves a truncated cache file behind
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp_path, cache_path)
+
+        # Remove the least recently used cache files
+        cached = sorted(glob(os.path.join(cache_dir, "band-*.npy")),
+                        key=os.path.getmtime)
+        for old_path in cached[:-max_entries]:
+            os.remove(old_path)
+
+    return np.load(cache_path, mmap_mode="r")
+
+
+def apply_cloud_mask(arr, cloud_mask):
+    """Mask the pixels flagged in a 2D cloud mask in every band of arr.
+
+    If arr is a masked array, the cloud mask is combined with its existing
+    mask in place and arr is returned. Otherwise a masked array that shares
+    the data of arr is returned. Either way the data are not copied.
+    """
+    if np.ma.isMaskedArray(arr):
+        mask = np.ma.getmaskarray(arr)
+    else:
+        mask = np.zeros(arr.shape, dtype=bool)
+
+    np.logical_or(mask, cloud_mask[np.newaxis, :, :], out=mask)
+
+    if np.ma.isMaskedArray(arr):
+        arr.mask = mask
+        return arr
+    return np.ma.masked_array(arr, mask=mask, copy=False)
+
+
+@functools.lru_cache(maxsize=8)
+def build_qa_legend(vals):
+    """Build a colormap, normalization and legend patches for QA values.
+
+    vals is a sorted tuple of the unique values in a QA layer. Each value
+    gets its own color. The results are cached, so plotting a layer with
+    the same values again reuses them.
+    """
+    # Create a colormap with 11 colors
+    cmap = plt.cm.get_cmap('tab20b', 11)
+    bins = [0] + list(vals)
+    # Normalize the colormap
+    bounds = [((a + b) / 2) for a, b in zip(bins[:-1], bins[1::1])] + \
+        [(bins[-1] - bins[-2]) + bins[-1]]
+    norm = colors.BoundaryNorm(bounds, cmap.N)
+    # Create one legend patch per value
+    handles = [mpatches.Patch(color=cmap(norm(val)), label=val)
+               for val in vals]
+    return cmap, norm, handles
+# -
+
 # Next, you will load and plot landsat data. If you are completing the earth analytics course, you have worked with these data already in your homework.
 #
 
@@ -88,22 +332,24 @@ landsat_paths_pre_path = os.path.join("data", "cold-springs-fire",
                                       "crop",
                                       "*band*.tif")
 
-landsat_paths_pre = glob(landsat_paths_pre_path)
-landsat_paths_pre.sort()
-
 # Stack the Landsat pre fire data
 landsat_pre_st_path = os.path.join("data", "cold-springs-fire",
                                    "outputs", "landsat_pre_st.tif")
 
-es.stack(landsat_paths_pre, landsat_pre_st_path)
+# Get a sorted list of the band files
+landsat_paths_pre = sorted(glob(landsat_paths_pre_path))
+
+with rio.Env(**gdal_options):
+    stack_bands(landsat_paths_pre, landsat_pre_st_path)
 
-# Read landsat pre fire data
-with rio.open(landsat_pre_st_path) as landsat_pre_src:
-    landsat_pre = landsat_pre_src.read(masked=True)
-    landsat_extent = plotting_extent(landsat_pre_src)
+    # Read the red, green and blue bands of the landsat pre fire data
+    # at a resolution suited for plotting
+    with rio.open(landsat_pre_st_path) as landsat_pre_src:
+        landsat_pre_rgb = read_for_plot(landsat_pre_src, indexes=[4, 3, 2])
+        landsat_extent = plotting_extent(landsat_pre_src)
 
-ep.plot_rgb(landsat_pre,
-            rgb=[3, 2, 1],
+ep.plot_rgb(to_display_uint8(landsat_pre_rgb),
+            rgb=[0, 1, 2],
             extent=landsat_extent,
             title="Landsat True Color Composite Image | 30 meters \n Post Cold Springs Fire \n July 8, 2016")
 
@@ -141,14 +387,21 @@ plt.show()
 # + {"tags": ["hide"]}
 # This is the code for masking
 
+# Read the full resolution landsat pre fire data to mask
+# Nodata pixels are masked too, so only skip the nodata mask if the file
+# has no nodata value
+with rio.Env(**gdal_options), rio.open(landsat_pre_st_path) as landsat_pre_src:
+    landsat_pre = landsat_pre_src.read(masked=landsat_pre_src.nodata is not None)
+
 # Create the path for the pixel_qa layer
 landsat_pre_cl_path = os.path.join("data", "cold-springs-fire", "landsat_collect",
                                    "LC080340322016070701T1-SC20180214145604", "crop",
                                    "LC08_L1TP_034032_20160707_20170221_01_T1_pixel_qa_crop.tif")
 
 # Open & read the pixel_qa layer for your landsat scene
+with rio.Env(**gdal_options):
+    landsat_qa = load_band_cached(landsat_pre_cl_path)
 with rio.open(landsat_pre_cl_path) as landsat_pre_cl:
-    landsat_qa = landsat_pre_cl.read(1)
     landsat_ext = plotting_extent(landsat_pre_cl)
 
 # Create a list of values that you want to set as "mask" in the pixel qa layer
@@ -158,11 +411,13 @@ cloud_shadow = em.pixel_flags["pixel_qa"]["L8"]["Cloud Shadow"]
 
 all_masked_values = cloud_shadow + cloud + high_cloud_confidence
 
+# Store the values to mask in a lookup table and create the cloud mask
+# in one pass over the pixel QA layer
+cloud_mask_lut = build_qa_lut([cloud_shadow, cloud, high_cloud_confidence])
+cl_mask = mask_from_lut(landsat_qa, cloud_mask_lut)
 
-# Call the earthpy mask function using pixel QA layer
-landsat_pre_cl_free = em.mask_pixels(arr=landsat_pre,
-                                     mask_arr = landsat_qa,
-                                     vals=all_masked_values)
+# Apply the cloud mask to the landsat stack
+landsat_pre_cl_free = apply_cloud_mask(landsat_pre, cl_mask)
 # -
 
 # Below I walk you through all of the code above so you better understand it.
@@ -181,36 +436,20 @@ landsat_pre_cl_free = em.mask_pixels(arr=landsat_pre,
 #
 # `LC80340322016189-SC20170128091153/crop/LC08_L1TP_034032_20160707_20170221_01_T1_pixel_qa_crop.tif`
 #
-# You will explore using this pixel quality assurance (QA) layer, next. To begin, open
-# the `pixel_qa` layer using rasterio and plot it with matplotlib.
+# You will explore using this pixel quality assurance (QA) layer, next. The masking code
+# above already opened the `pixel_qa` layer using rasterio and read it into `landsat_qa`, so you can plot it with matplotlib.
 #
 
-# +
-landsat_pre_cl_path = os.path.join("data", "cold-springs-fire",
-                                   "landsat_collect",
-                                   "LC080340322016070701T1-SC20180214145604",
-                                   "crop",
-                                   "LC08_L1TP_034032_20160707_20170221_01_T1_pixel_qa_crop.tif")
-
-# Open the pixel_qa layer for your landsat scene
-with rio.open(landsat_pre_cl_path) as landsat_pre_cl:
-    landsat_qa = landsat_pre_cl.read(1)
-    landsat_ext = plotting_extent(landsat_pre_cl)
-# -
-
 # First, plot the pixel_qa layer in matplotlib.
 
 # + {"caption": "Landsat Collection Pixel QA layer for the Cold Springs fire area."}
 # This is optional code to plot the qa layer - don't worry too much about the details.
-# Create a colormap with 11 colors
-cmap = plt.cm.get_cmap('tab20b', 11)
 # Get a list of unique values in the qa layer
-vals = np.unique(landsat_qa).tolist()
-bins = [0] + vals
-# Normalize the colormap
-bounds = [((a + b) / 2) for a, b in zip(bins[:-1], bins[1::1])] + \
-    [(bins[-1] - bins[-2]) + bins[-1]]
-norm = colors.BoundaryNorm(bounds, cmap.N)
+# Counting each value is a single pass over the data (np.unique sorts it)
+counts = np.bincount(landsat_qa.ravel())
+vals = np.nonzero(counts)[0].tolist()
+# Create a colormap, normalization and legend with one color per value
+cmap, norm, handles = build_qa_legend(tuple(vals))
 
 # Plot the data
 fig, ax = plt.subplots(figsize=(12, 8))
@@ -219,10 +458,10 @@ im = ax.imshow(landsat_qa,
                cmap=cmap,
                norm=norm)
 
-ep.draw_legend(im,
-               classes=vals,
-               cmap=cmap,
-               titles=vals)
+ax.legend(handles=handles,
+          bbox_to_anchor=(1.05, 1),
+          loc=2,
+          borderaxespad=0)
 
 ax.set_title("Landsat Collection Quality Assessment Layer")
 ax.set_axis_off()
@@ -274,10 +513,12 @@ plt.show()
 # Reclassifying the data allows us to enforce one color for each unique value in our data.
 #
 
-# This next section shows you how to create a mask using the earthpy mask helper function `_create_mask` to create a binary cloud mask layer. In this mask all pixels that you wish to remove from your analysis or mask will be set to `1`. All other pixels which represent pixels you want to use in your analysis will be set to `0`.
+# This next section shows you how to create a mask using the `create_qa_mask` helper function defined at the top of this lesson to create a binary cloud mask layer. In this mask all pixels that you wish to remove from your analysis or mask will be set to `1` (`True`). All other pixels which represent pixels you want to use in your analysis will be set to `0` (`False`).
+#
+# `create_qa_mask` does the same thing as the earthpy helper `em._create_mask`, but it looks every pixel up in a table of masked values in a single pass, rather than comparing the whole raster against each masked value one at a time.
 #
 # ### NOTE:
-# This step can be done by changing the inputs into the main `mask_pixels` function. We include it here so you can see what is going on in the function. See lower down in the lesson for this call.
+# This step can be done in the same line of code that applies the mask. We include it here so you can see what is going on. See lower down in the lesson for this call.
 
 # +
 # You can grab the cloud pixel values from earthpy
@@ -289,13 +530,13 @@ all_masked_values = cloud_shadow + cloud + high_cloud_confidence
 all_masked_values
 # -
 
-# This is using a helper function from earthpy to create the mask so we can plot it
+# This is using the helper function from the top of the lesson to create the mask so we can plot it
 # You don't need to do this in your workflow as you can perform the mask in one step
 # But we have it here for demonstration purposes
-cl_mask = em._create_mask(landsat_qa, all_masked_values)
+cl_mask = create_qa_mask(landsat_qa, all_masked_values)
 np.unique(cl_mask)
 
-# Below is the plot of the reclassified raster mask created from the `_create_mask` helper function.
+# Below is the plot of the reclassified raster mask created from the `create_qa_mask` helper function.
 
 # + {"caption": "Landsat image in which the masked pixels (cloud) are rendered in light purple.", "tags": ["hide"]}
 fig, ax = plt.subplots(figsize=(12, 8))
@@ -333,20 +574,20 @@ plt.show()
 #
 # 1. Make sure you use a raster layer for the mask that is the SAME EXTENT and the same pixel resolution as your landsat scene. In this case you have a mask layer that is already the same spatial resolution and extent as your landsat scene.
 # 2. Set all of the values in that layer that are clouds and / or shadows to `1` (1 to represent `mask = True`)
-# 3. Finally you use the `masked_array` function to apply the mask layer to the numpy array (or the landsat scene that you are working with in Python).  all pixel locations that were flagged as clouds or shadows in your mask to `NA` in your `raster` or in this case `rasterstack`.
+# 3. Finally you add the mask layer to the mask of the numpy masked array (or the landsat scene that you are working with in Python). This sets all pixel locations that were flagged as clouds or shadows in your mask to `NA` in your `raster` or in this case `rasterstack`.
 #
-# ## Mask A Landsat Scene Using EarthPy
-# Below you mask your data in one single step. This function `em.mask_pixels()` creates the mask as you saw above and then masks your data.
+# ## Mask A Landsat Scene
+# Below you mask your data in one single step. The earthpy function `em.mask_pixels()` can do this too, but it returns a new masked copy of your whole landsat stack. The `apply_cloud_mask` helper function instead wraps `landsat_pre` in a masked array that shares its data (or adds the cloud mask to the existing mask of a masked array), so the data are not copied. The 2D cloud mask is applied to every band.
 
-# Call the earthpy mask function using your mask layer
-landsat_pre_cl_free = em.mask_pixels(landsat_pre, cl_mask)
+# Apply your mask layer to the landsat stack
+landsat_pre_cl_free = apply_cloud_mask(landsat_pre, cl_mask)
 
-# Alternatively, you can directly input your mask values and the pixel QA layer into the `mask_pixels` function. This is the easiest way to mask your data!
+# Alternatively, you can create the mask from your mask values and the pixel QA layer and apply it in one step. This is the easiest way to mask your data!
 
-# Call the earthpy mask function using pixel QA layer
-landsat_pre_cl_free = em.mask_pixels(landsat_pre, 
-                                     landsat_qa, 
-                                     vals=all_masked_values)
+# Create the mask from the pixel QA layer and apply it
+landsat_pre_cl_free = apply_cloud_mask(landsat_pre,
+                                       create_qa_mask(landsat_qa,
+                                                      all_masked_values))
 
 # + {"caption": "CIR Composite image in grey scale with mask applied, covering the post-Cold Springs fire area on July 8, 2016."}
 # Plot the data
@@ -358,9 +599,9 @@ ep.plot_bands(landsat_pre_cl_free[6],
 plt.show()
 
 # + {"caption": "CIR Composite image with cloud mask applied, covering the post-Cold Springs fire area on July 8, 2016."}
-# Plot data
-ep.plot_rgb(landsat_pre_cl_free,
-            rgb=[4, 3, 2],
+# Plot data (stretched to 8 bit values for display)
+ep.plot_rgb(to_display_uint8(landsat_pre_cl_free[[4, 3, 2]]),
+            rgb=[0, 1, 2],
             extent=landsat_ext,
             title="Landsat CIR Composite Image | 30 meters \n Post Cold Springs Fire \n July 8, 2016")
 plt.show()
@@ -1,9 +1,8 @@
 """
-This script will convert jupyter notebooks into Jekyll-style markdown
-files, and place them in the appropriate folder. It will also move
-the images properly so that they are in their own separate directory.
-It will only do this for notebook files that are NEWER than their
-corresponding jekyll markdown files.
+This script runs jupyter notebooks with papermill to check that they
+build. Every notebook passed in is rebuilt - it does not (yet) write
+Jekyll-style markdown files, so there is nothing to compare against
+to skip notebooks that have not changed.
 
 How to use
 
@@ -24,9 +23,11 @@ import os
 import os.path as op
 import shutil as sh
 import sys
+import re
 import papermill as pm
 import traceback
 import signal
+import concurrent.futures
 
 def generate_paths(notebook_path):
 
@@ -54,11 +55,13 @@ def generate_paths(notebook_path):
 
     ## paths for pre-processing
     # Temporary directory for notebook files
-    if not op.isdir(op.join('.', 'tmp')):
-        os.makedirs(op.join('.', 'tmp'))
+    # (notebooks are built in parallel, so the dir may appear at any time)
+    os.makedirs(op.join('.', 'tmp'), exist_ok=True)
 
-    # This is the path where the temp notebook will be stored
-    path_ipynb_tmp_file = op.join('tmp', op.basename(notebook_path))
+    # This is the path where the temp notebook will be stored. It is named
+    # after the whole relative path so notebooks with the same file name in
+    # different dirs don't overwrite each other
+    path_ipynb_tmp_file = op.join('tmp', op.relpath(notebook_path).replace(os.sep, '__'))
 
     # Create final dict of all path names
     paths = {'path_save_tmp_file': path_ipynb_tmp_file}
@@ -125,33 +128,18 @@ def rebuild_notebook(notebook_path):
     normalize_kernel_name(ntbk_json, ntbk_tmp_path)
 
     # --- Papermill run notebook---
-    print("Running notebook using papermill: ", ntbk_tmp_path)
-    # Run notebook with papermill
+    print("Running notebook using papermill: ", ntbk_tmp_path, flush=True)
+    # Run notebook with papermill. The executed notebook is only written
+    # to the tmp dir, so don't save it after every cell. The progress bar
+    # stays on: its output keeps the CI step alive on long notebooks
     pm.execute_notebook(
         ntbk_tmp_path,
-        ntbk_tmp_path
+        ntbk_tmp_path,
+        log_output=False,
+        request_save_on_cell_execute=False
     )
 
 
-# --- Get notebooks to rebuild - ONLY run if there are files provided to run---
-if len(sys.argv) > 1:
-
-        # otherwise, just rebuild the notebooks that were changed but REMOVE any in the ignored category
-        notebooks_to_rebuild = sys.argv[1:]
-
-        notebooks_to_rebuild = sorted(notebooks_to_rebuild)
-
-        # Print friendly message about what is building
-        if len(notebooks_to_rebuild) > 0:
-            print('Processing the following dirs:')
-            print('\n'.join(notebooks_to_rebuild))
-        else:
-            print("No changes found. There are no notebooks to rebuild.")
-
-else:
-    # exit early if no notebooks given
-    sys.exit('No notebooks to rebuild.')
-
 # --- Setup handler for rebuild timeout ---
 # This is when a notebook runs very slowly like the twitter api notebooks
 # might trigger this
@@ -159,61 +147,218 @@ else:
 def handler(signum, frame):
     raise Exception('Notebook build timed out.')
 
-# Register the signal function handler
-signal.signal(signal.SIGALRM, handler)
 
-# set timeout
-signal.alarm(570)
+def build_notebook(notebook_path):
 
-# --- Run, cleanup and convert notebooks to markdown ---
+    """
+    Rebuilds a single notebook in a worker process. The build
+    times out after 570 seconds.
 
-problem_notebooks = []
+    Parameters
+    ----------
+        notebook_path : str
+            A string containing the path of the target notebook
+            to rebuild.
 
-# Run all notebooks and create markdown
-failed_count = 0
-total_notebooks_built = 0
-for total_num, notebook in enumerate(notebooks_to_rebuild):
+    Return
+    ------
+        None if the notebook built, otherwise a string containing
+        the traceback of the error.
+    """
 
-    print("Building Lesson: ", notebook)
+    # SIGALRM is only delivered to the main thread of a process, so
+    # the timeout is set in each worker rather than in the parent
+    signal.signal(signal.SIGALRM, handler)
+    signal.alarm(570)
 
     try:
-        rebuild_notebook(notebook)
-        print("SUCCESS! I built:", notebook)
-        total_notebooks_built += 1
-    except Exception as ex:
-        traceback.print_exception(type(ex), ex, ex.__traceback__)
-        problem_notebooks.append(notebook)
-        failed_count += 1
-        continue
-
-print("I built, ", total_notebooks_built, "notebooks.")
-if failed_count > 0:
-    print("Unfortunately for you, ", failed_count, "notebooks failed." )
-
-# If the tmp dir exists clean it out
-tmp_path = op.join('.', 'tmp')
-if os.path.exists(tmp_path):
-    sh.rmtree(tmp_path)
-
-if len(problem_notebooks) > 0:
-    # readout of notebook conversion errors
-    print('\nEncountered errors with the following notebooks:\n')
-
-    for prob in problem_notebooks:
-        print(prob)
-else:
-    print("All notebooks built successfully!")
-
-# write problem notebooks to log file
-with open('nb_errors.txt', 'a') as log:
-    for nb in problem_notebooks:
-        if not nb is None: # skip writing to log if no problem notebooks
-            log.write('{}\n'.format(nb))
-
-# write successful notebooks to log file
-successful_notebooks = [x for x in notebooks_to_rebuild if x not in problem_notebooks]
-
-with open('ipynb_files_built.txt', 'w') as log:
-    for nb in successful_notebooks:
-        if not nb is None: # skip writing to log if no successful notebooks
-            log.write('{}\n'.format(nb))
+        rebuild_notebook(notebook_path)
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        signal.alarm(0)
+
+    return None
+
+
+def build_notebook_group(notebook_paths):
+
+    """
+    Rebuilds a group of notebooks one after another in a single
+    worker process. The result of each notebook is printed (and
+    flushed) as soon as it finishes, so CI sees output while the
+    rest of the group builds.
+
+    Parameters
+    ----------
+        notebook_paths : list
+            A list of paths of the target notebooks to rebuild.
+
+    Return
+    ------
+        A list of (notebook path, error) tuples, where error is
+        the value returned by build_notebook.
+    """
+
+    results = []
+    for nb in notebook_paths:
+        print("Building Lesson: ", nb, flush=True)
+        error = build_notebook(nb)
+        if error is None:
+            print("SUCCESS! I built:", nb, flush=True)
+        else:
+            print(error, flush=True)
+        results.append((nb, error))
+
+    return results
+
+
+def get_datasets(notebook_path):
+
+    """
+    Finds the earthpy datasets that a notebook downloads.
+
+    Parameters
+    ----------
+        notebook_path : str
+            A string containing the path of the target notebook.
+
+    Return
+    ------
+        A set of the dataset keys or urls passed to et.data.get_data
+        in the code cells of the notebook.
+    """
+
+    try:
+        nb = nf.read(notebook_path, nf.NO_CONVERT)
+    except Exception:
+        # Unreadable notebooks fail (and are logged) when they are built
+        return set()
+
+    code = '\n'.join(cell.source for cell in nb.cells
+                     if cell.cell_type == 'code')
+    return set(re.findall(
+        r"get_data\(\s*(?:(?:key|url)\s*=\s*)?['\"]([^'\"]+)['\"]", code))
+
+
+def group_notebooks(notebook_paths):
+
+    """
+    Groups notebooks that download any of the same earthpy datasets.
+    Notebooks in a group must be built one after another, otherwise
+    they race to download and unzip the same data into
+    ~/earth-analytics.
+
+    Parameters
+    ----------
+        notebook_paths : list
+            A list of paths of the target notebooks to rebuild.
+
+    Return
+    ------
+        A list of groups, each a sorted list of notebook paths.
+    """
+
+    groups = []
+    for notebook in notebook_paths:
+        group = {'notebooks': [notebook], 'datasets': get_datasets(notebook)}
+        # Merge every existing group that shares a dataset with this one
+        for other in [g for g in groups if g['datasets'] & group['datasets']]:
+            group['notebooks'] += other['notebooks']
+            group['datasets'] |= other['datasets']
+            groups.remove(other)
+        groups.append(group)
+
+    return [sorted(g['notebooks']) for g in groups]
+
+
+if __name__ == '__main__':
+
+    # --- Get notebooks to rebuild - ONLY run if there are files provided to run---
+    if len(sys.argv) > 1:
+
+        # otherwise, just rebuild the notebooks that were changed but REMOVE any in the ignored category
+        notebooks_to_rebuild = sys.argv[1:]
+
+        notebooks_to_rebuild = sorted(notebooks_to_rebuild)
+
+        # Print friendly message about what is building
+        if len(notebooks_to_rebuild) > 0:
+            print('Processing the following dirs:')
+            print('\n'.join(notebooks_to_rebuild))
+        else:
+            print("No changes found. There are no notebooks to rebuild.")
+
+    else:
+        # exit early if no notebooks given
+        sys.exit('No notebooks to rebuild.')
+
+    # --- Configure GDAL for the notebook kernels ---
+    # Kernels inherit this from this process: a 512 MB raster block cache
+    os.environ.setdefault('GDAL_CACHEMAX', '512')
+
+    # --- Run, cleanup and convert notebooks to markdown ---
+
+    problem_notebooks = []
+
+    # Run groups of notebooks that share no data in parallel and create
+    # markdown. The number of workers is capped because each notebook
+    # kernel can run multithreaded code (e.g. GDAL) of its own
+    failed_count = 0
+    total_notebooks_built = 0
+    notebook_groups = group_notebooks(notebooks_to_rebuild)
+    max_workers = max(1, min(4, os.cpu_count() or 1, len(notebook_groups)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for group in notebook_groups:
+            futures[executor.submit(build_notebook_group, group)] = group
+
+        for fut in concurrent.futures.as_completed(futures):
+            try:
+                results = fut.result()
+            except Exception as ex:
+                # The worker process itself failed
+                error = ''.join(traceback.format_exception(
+                    type(ex), ex, ex.__traceback__))
+                print(error, flush=True)
+                results = [(nb, error) for nb in futures[fut]]
+
+            # Each notebook's result was already printed by the worker
+            for notebook, error in results:
+                if error is None:
+                    total_notebooks_built += 1
+                else:
+                    problem_notebooks.append(notebook)
+                    failed_count += 1
+
+    print("I built, ", total_notebooks_built, "notebooks.")
+    if failed_count > 0:
+        print("Unfortunately for you, ", failed_count, "notebooks failed." )
+
+    # If the tmp dir exists clean it out
+    tmp_path = op.join('.', 'tmp')
+    if os.path.exists(tmp_path):
+        sh.rmtree(tmp_path)
+
+    if len(problem_notebooks) > 0:
+        # readout of notebook conversion errors
+        print('\nEncountered errors with the following notebooks:\n')
+
+        for prob in problem_notebooks:
+            print(prob)
+    else:
+        print("All notebooks built successfully!")
+
+    # write problem notebooks to log file
+    with open('nb_errors.txt', 'a') as log:
+        for nb in problem_notebooks:
+            if not nb is None: # skip writing to log if no problem notebooks
+                log.write('{}\n'.format(nb))
+
+    # write successful notebooks to log file
+    successful_notebooks = [x for x in notebooks_to_rebuild if x not in problem_notebooks]
+
+    with open('ipynb_files_built.txt', 'w') as log:
+        for nb in successful_notebooks:
+            if not nb is None: # skip writing to log if no successful notebooks
+                log.write('{}\n'.format(nb))